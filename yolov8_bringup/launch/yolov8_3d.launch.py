@@ -115,6 +115,31 @@ def generate_launch_description():
         default_value="0.3",
         description="Maximum detection threshold in the z axis")
 
+    estimate_depth_extent = LaunchConfiguration("estimate_depth_extent")
+    estimate_depth_extent_cmd = DeclareLaunchArgument(
+        "estimate_depth_extent",
+        default_value="True",
+        description="Whether to measure the size in the z axis from the depth image or approximate it with the width, "
+                    "when disabled the 3D boxes without depth values close to their average are not discarded")
+
+    republish_source_img = LaunchConfiguration("republish_source_img")
+    republish_source_img_cmd = DeclareLaunchArgument(
+        "republish_source_img",
+        default_value="False",
+        description="Whether to include the RGB image in the 3D detections")
+
+    sync_queue_size = LaunchConfiguration("sync_queue_size")
+    sync_queue_size_cmd = DeclareLaunchArgument(
+        "sync_queue_size",
+        default_value="10",
+        description="Queue size of the synchronizer of the depth and detection topics")
+
+    sync_slop = LaunchConfiguration("sync_slop")
+    sync_slop_cmd = DeclareLaunchArgument(
+        "sync_slop",
+        default_value="0.1",
+        description="Maximum delay in seconds between synchronized messages")
+
     namespace = LaunchConfiguration("namespace")
     namespace_cmd = DeclareLaunchArgument(
         "namespace",
@@ -159,6 +184,10 @@ def generate_launch_description():
         parameters=[{
             "target_frame": target_frame,
             "maximum_detection_threshold": maximum_detection_threshold,
+            "estimate_depth_extent": estimate_depth_extent,
+            "republish_source_img": republish_source_img,
+            "sync_queue_size": sync_queue_size,
+            "sync_slop": sync_slop,
             "depth_image_units_divisor": depth_image_units_divisor,
             "depth_image_reliability": depth_image_reliability,
             "depth_info_reliability": depth_info_reliability
@@ -199,6 +228,10 @@ def generate_launch_description():
     ld.add_action(depth_image_units_divisor_cmd)
     ld.add_action(target_frame_cmd)
     ld.add_action(maximum_detection_threshold_cmd)
+    ld.add_action(estimate_depth_extent_cmd)
+    ld.add_action(republish_source_img_cmd)
+    ld.add_action(sync_queue_size_cmd)
+    ld.add_action(sync_slop_cmd)
     ld.add_action(namespace_cmd)
 
     ld.add_action(detector_node_cmd)
@@ -43,13 +43,18 @@ from yolov8_msgs.msg import DetectionArray
 from yolov8_msgs.msg import KeyPoint3D
 from yolov8_msgs.msg import KeyPoint3DArray
 from yolov8_msgs.msg import BoundingBox3D
-from yolov8_msgs.msg import KeyPoint2D
-from yolov8_msgs.msg import Point2D
 
 # importa la librería de OpenCV
 import cv2
 
 
+DEPTH_ENCODINGS = {
+    "16UC1": np.uint16,
+    "mono16": np.uint16,
+    "32FC1": np.float32,
+}
+
+
 class Detect3DNode(CascadeLifecycleNode):
 
     def __init__(self) -> None:
@@ -72,6 +77,22 @@ class Detect3DNode(CascadeLifecycleNode):
         self.depth_image_units_divisor = self.get_parameter(
             "depth_image_units_divisor").get_parameter_value().integer_value
 
+        self.declare_parameter("estimate_depth_extent", True)
+        self.estimate_depth_extent = self.get_parameter(
+            "estimate_depth_extent").get_parameter_value().bool_value
+
+        self.declare_parameter("republish_source_img", False)
+        self.republish_source_img = self.get_parameter(
+            "republish_source_img").get_parameter_value().bool_value
+
+        self.declare_parameter("sync_queue_size", 10)
+        self.sync_queue_size = self.get_parameter(
+            "sync_queue_size").get_parameter_value().integer_value
+
+        self.declare_parameter("sync_slop", 0.1)
+        self.sync_slop = self.get_parameter(
+            "sync_slop").get_parameter_value().double_value
+
         self.declare_parameter("depth_image_reliability",
                                QoSReliabilityPolicy.BEST_EFFORT)
         self.depth_image_qos_profile = QoSProfile(
@@ -119,7 +140,8 @@ class Detect3DNode(CascadeLifecycleNode):
             self, DetectionArray, "detections")
 
         self._synchronizer = message_filters.ApproximateTimeSynchronizer(
-            (self.rgb_sub, self.depth_sub, self.depth_info_sub, self.detections_sub), 10, 0.5)
+            (self.rgb_sub, self.depth_sub, self.depth_info_sub, self.detections_sub),
+            self.sync_queue_size, self.sync_slop)
         self._synchronizer.registerCallback(self.on_detections)
 
         return super().on_activate(state)
@@ -153,7 +175,10 @@ class Detect3DNode(CascadeLifecycleNode):
 
         new_detections_msg = DetectionArray()
         new_detections_msg.header = detections_msg.header
-        new_detections_msg.source_img = rgb_msg
+
+        # the image is only copied if it is requested
+        if self.republish_source_img:
+            new_detections_msg.source_img = rgb_msg
 
         new_detections_msg.detections = self.process_detections(
             depth_msg, depth_info_msg, detections_msg)
@@ -176,203 +201,273 @@ class Detect3DNode(CascadeLifecycleNode):
             return []
 
         new_detections = []
-        depth_image = self.cv_bridge.imgmsg_to_cv2(depth_msg)
+        depth_image = self.depth_msg_to_ndarray(depth_msg)
+
+        # camera intrinsics and scale factors for this frame
+        k = depth_info_msg.k
+        self._px, self._py = k[2], k[5]
+        self._inv_fx = 1.0 / k[0]
+        self._inv_fy = 1.0 / k[4]
+        self._inv_div = 1.0 / self.depth_image_units_divisor
+
+        detections = detections_msg.detections
+        height, width = depth_image.shape[:2]
+
+        # 2D BBs and the centers used to locate them in 3D
+        bboxes = np.array([
+            (int(d.bbox.center.position.x), int(d.bbox.center.position.y),
+             int(d.bbox.size.x), int(d.bbox.size.y))
+            for d in detections
+        ], dtype=np.intp)
+        centers = np.array([Detect3DNode.get_bb_center(d) for d in detections],
+                           dtype=np.intp)
+
+        # sample the depth of all the centers inside the image at once
+        inside = (centers[:, 0] >= 0) & (centers[:, 0] < width) & \
+            (centers[:, 1] >= 0) & (centers[:, 1] < height)
+        center_z = np.zeros(len(detections), dtype=depth_image.dtype)
+        center_z[inside] = depth_image[centers[inside, 1], centers[inside, 0]]
+        has_depth = np.isfinite(center_z) & (center_z != 0)
+
+        # project centers and sizes to the plane z = 1
+        rays = np.empty((len(detections), 4), dtype=np.float64)
+        rays[:, 0] = (centers[:, 0] - self._px) * self._inv_fx
+        rays[:, 1] = (centers[:, 1] - self._py) * self._inv_fy
+        rays[:, 2] = bboxes[:, 2] * self._inv_fx
+        rays[:, 3] = bboxes[:, 3] * self._inv_fy
+
+        # 3D BBs of the detections with depth in their centers
+        indices = np.flatnonzero(has_depth)
+        found, positions, sizes = self.convert_bbs_to_3d(
+            depth_image, bboxes[indices], rays[indices])
+
+        indices = indices[found]
+        positions, sizes = Detect3DNode.transform_3d_boxes(
+            positions[found], sizes[found], transform[0], transform[1])
+
+        # create 3D BBs
+        for i, position, size in zip(indices.tolist(),
+                                     positions.tolist(), sizes.tolist()):
+            detection = detections[i]
+
+            bbox3d = BoundingBox3D()
+            bbox3d.center.position.x, bbox3d.center.position.y, \
+                bbox3d.center.position.z = position
+            bbox3d.size.x, bbox3d.size.y, bbox3d.size.z = size
+            bbox3d.frame_id = self.target_frame
+            detection.bbox3d = bbox3d
+
+            if detection.keypoints.data:
+                keypoints3d = self.convert_keypoints_to_3d(
+                    depth_image, detection, transform[0], transform[1])
+                keypoints3d.frame_id = self.target_frame
+                detection.keypoints3d = keypoints3d
+
+            new_detections.append(detection)
 
-        for detection in detections_msg.detections:
-            bbox3d = self.convert_bb_to_3d(
-                depth_image, depth_info_msg, detection)
+        return new_detections
 
-            if bbox3d is not None:
-                new_detections.append(detection)
+    def depth_msg_to_ndarray(self, msg: Image) -> np.ndarray:
 
-                bbox3d = Detect3DNode.transform_3d_box(
-                    bbox3d, transform[0], transform[1])
-                bbox3d.frame_id = self.target_frame
-                new_detections[-1].bbox3d = bbox3d
+        dtype = DEPTH_ENCODINGS.get(msg.encoding)
 
-                if detection.keypoints.data:
-                    keypoints3d = self.convert_keypoints_to_3d(
-                        depth_image, depth_info_msg, detection)
-                    keypoints3d = Detect3DNode.transform_3d_keypoints(
-                        keypoints3d, transform[0], transform[1])
-                    keypoints3d.frame_id = self.target_frame
-                    new_detections[-1].keypoints3d = keypoints3d
+        # unsupported encodings go through cv_bridge
+        if dtype is None:
+            return self.cv_bridge.imgmsg_to_cv2(msg)
 
-        return new_detections
+        # view that aliases msg.data, no copy is done, so it must not be modified
+        dtype = np.dtype(dtype).newbyteorder(">" if msg.is_bigendian else "<")
+        depth_image = np.frombuffer(msg.data, dtype=dtype)
 
-    def convert_bb_to_3d(
-        self,
-        depth_image: np.ndarray,
-        depth_info: CameraInfo,
-        detection: Detection
-    ) -> BoundingBox3D:
-
-        # crop depth image by the 2d BB
-        center_x = int(detection.bbox.center.position.x)
-        center_y = int(detection.bbox.center.position.y)
-        size_x = int(detection.bbox.size.x)
-        size_y = int(detection.bbox.size.y)
-
-        u_min = max(center_x - size_x // 2, 0)
-        u_max = min(center_x + size_x // 2, depth_image.shape[1] - 1)
-        v_min = max(center_y - size_y // 2, 0)
-        v_max = min(center_y + size_y // 2, depth_image.shape[0] - 1)
-
-        roi = depth_image[v_min:v_max, u_min:u_max] / \
-            self.depth_image_units_divisor  # convert to meters
-        
-        if not np.any(roi):
-            return None
+        # rows may be padded, so use the step to build the view
+        depth_image = depth_image.reshape(
+            msg.height, msg.step // dtype.itemsize)[:, :msg.width]
+
+        # swap only if the endianness differs from the host one
+        if not dtype.isnative:
+            depth_image = depth_image.astype(dtype.newbyteorder("="))
 
-        # find the z coordinate on the 3D BB
-        up = Point2D()
-        down = Point2D()
-        up_detected = False
-        down_detected = False
-
-        kp5 = KeyPoint2D()
-        kp6 = KeyPoint2D()
-        kp11 = KeyPoint2D()
-        kp12 = KeyPoint2D()
-
-        # get the keypoints
-        for kp in detection.keypoints.data:
-            if kp.id == 5:
-                kp5 = kp
-                up_detected = True
-            elif kp.id == 6:
-                kp6 = kp
-                up_detected = True
-            elif kp.id == 11:
-                kp11 = kp
-                down_detected = True
-            elif kp.id == 12:
-                kp12 = kp
-                down_detected = True
-
-        # if the keypoints are detected get the keypoint with better score    
-        if up_detected and down_detected:
-            up = kp5 if kp5.score > kp6.score else kp6
-            down = kp11 if kp11.score > kp12.score else kp12
+        return depth_image
 
+    @staticmethod
+    def get_bb_center(detection: Detection) -> Tuple[int, int]:
+
+        center_x = detection.bbox.center.position.x
+        center_y = detection.bbox.center.position.y
+
+        # find the z coordinate on the 3D BB using shoulders and hips
+        picks = {kp.id: kp for kp in detection.keypoints.data
+                 if kp.id in (5, 6, 11, 12)}
+
+        # get the keypoints with better score
+        up = max((picks[i] for i in (5, 6) if i in picks),
+                 key=lambda kp: kp.score, default=None)
+        down = max((picks[i] for i in (11, 12) if i in picks),
+                   key=lambda kp: kp.score, default=None)
+
+        if up is not None and down is not None:
             center_x = (up.point.x + down.point.x) / 2
             center_y = (up.point.y + down.point.y) / 2
 
-        if up_detected and not down_detected:
-            up = kp5 if kp5.score > kp6.score else kp6
-
+        elif up is not None:
             center_x = up.point.x
             center_y = up.point.y
 
-        if down_detected and not up_detected:
-            down = kp11 if kp11.score > kp12.score else kp12
-
+        elif down is not None:
             center_x = down.point.x
             center_y = down.point.y
 
-        # if the keypoints are detected
-        if up_detected and down_detected:
-            # get shoulder with better score
-            if kp5.score > kp6.score:
-                up = kp5
-            else:
-                up = kp6
+        return int(center_x), int(center_y)
 
-            # get hip with better score
-            if kp11.score > kp12.score:
-                down = kp11
-            else:
-                down = kp12
+    def convert_bbs_to_3d(
+        self,
+        depth_image: np.ndarray,
+        bboxes: np.ndarray,
+        rays: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+        found = np.zeros(len(bboxes), dtype=bool)
+        roi_stats = np.zeros((len(bboxes), 3), dtype=np.float64)
+        height, width = depth_image.shape[:2]
+
+        for i, (center_x, center_y, size_x, size_y) in enumerate(bboxes.tolist()):
+
+            # crop depth image by the 2d BB
+            u_min = max(center_x - size_x // 2, 0)
+            u_max = min(center_x + size_x // 2, width - 1)
+            v_min = max(center_y - size_y // 2, 0)
+            v_max = min(center_y + size_y // 2, height - 1)
+
+            # keep the raw depth units, scaling is applied to the results only
+            stats = Detect3DNode.compute_roi_stats(
+                depth_image[v_min:v_max, u_min:u_max],
+                self.depth_image_units_divisor,
+                self.maximum_detection_threshold,
+                self.estimate_depth_extent
+            )
+
+            if stats is not None:
+                found[i] = True
+                roi_stats[i] = stats
 
-            center_x = (up.point.x + down.point.x) / 2
-            center_y = (up.point.y + down.point.y) / 2
-        
+        # project from image to world space
+        average_z_coord = roi_stats[:, 0]
+        positions = np.column_stack((
+            average_z_coord * rays[:, 0],
+            average_z_coord * rays[:, 1],
+            average_z_coord
+        ))
+        width = average_z_coord * rays[:, 2]
+
+        # without the depth band, the extent is assumed to be the width
+        if self.estimate_depth_extent:
+            depth_size = roi_stats[:, 2] - roi_stats[:, 1]
+        else:
+            depth_size = width
 
-        # check center_x and center_y inside the image limits
-        center_x = int(center_x)
-        center_y = int(center_y)
+        sizes = np.column_stack((
+            width,
+            average_z_coord * rays[:, 3],
+            depth_size
+        ))
 
-        if center_x < 0 or center_x >= depth_image.shape[1] or \
-                center_y < 0 or center_y >= depth_image.shape[0]:
-            return None
+        return found, positions, sizes
 
-        bb_center_z_coord = depth_image[int(center_y)][int(
-            center_x)] / self.depth_image_units_divisor
+    @staticmethod
+    def compute_roi_stats(
+        roi: np.ndarray,
+        divisor: float,
+        threshold: float,
+        estimate_extent: bool = True
+    ) -> Optional[Tuple[float, float, float]]:
+
+        # average depth of the valid pixels, in raw units
+        if roi.dtype.kind == "f":
+            valid = np.isfinite(roi) & (roi > 0)
+        else:
+            valid = roi > 0
 
-        # if the center of the BB is not detected
-        if np.isnan(bb_center_z_coord) or \
-                bb_center_z_coord == 0 or \
-                np.isinf(bb_center_z_coord):
+        count = np.count_nonzero(valid)
+        if count == 0:
             return None
 
-        # if the center of the BB is detected
-        roi = np.ma.masked_invalid(roi)
-        if np.any(np.isfinite(roi)) and np.any(roi != 0):
-            average_z_coord = np.mean(roi[roi>0])
-        else:
-            return None
-        
-        z_diff = np.abs(roi - average_z_coord)
-        mask_z = z_diff <= self.maximum_detection_threshold
+        average_raw = np.sum(roi, where=valid, dtype=np.float64) / count
+        average_z_coord = float(average_raw / divisor)
+
+        # skip the depth band refinement, there are no z limits
+        # and BBs without pixels close to the average are not rejected
+        if not estimate_extent:
+            return average_z_coord, np.nan, np.nan
+
+        # pixels close to the average, the band is scaled to raw units
+        # and compared in place, without a float copy of the roi
+        threshold_raw = threshold * divisor
+        mask_z = (roi >= average_raw - threshold_raw) & \
+            (roi <= average_raw + threshold_raw)
         if not np.any(mask_z):
             return None
 
         roi_threshold = roi[mask_z]
-        z_min, z_max = np.min(roi_threshold), np.max(roi_threshold)
+        z_min, z_max = roi_threshold.min(), roi_threshold.max()
 
-        # project from image to world space
-        k = depth_info.k
-        px, py, fx, fy = k[2], k[5], k[0], k[4]
-        x = average_z_coord * (center_x - px) / fx
-        y = average_z_coord * (center_y - py) / fy
-        w = average_z_coord * (size_x / fx)
-        h = average_z_coord * (size_y / fy)
-
-        # create 3D BB
-        msg = BoundingBox3D()
-        msg.center.position.x = x
-        msg.center.position.y = y
-        msg.center.position.z = average_z_coord
-        msg.size.x = w
-        msg.size.y = h
-        msg.size.z = float(z_max - z_min)
-
-        return msg
+        # convert to meters
+        return (
+            average_z_coord,
+            float(z_min / divisor),
+            float(z_max / divisor)
+        )
 
     def convert_keypoints_to_3d(
         self,
         depth_image: np.ndarray,
-        depth_info: CameraInfo,
-        detection: Detection
+        detection: Detection,
+        translation: np.ndarray,
+        rotation: np.ndarray
     ) -> KeyPoint3DArray:
 
+        msg_array = KeyPoint3DArray()
+
+        num_keypoints = len(detection.keypoints.data)
+        if num_keypoints == 0:
+            return msg_array
+
         # build an array of 2d keypoints
-        keypoints_2d = np.array([[p.point.x, p.point.y]
-                                for p in detection.keypoints.data], dtype=np.int16)
-        u = np.array(keypoints_2d[:, 1]).clip(0, depth_info.height - 1)
-        v = np.array(keypoints_2d[:, 0]).clip(0, depth_info.width - 1)
-
-        # sample depth image and project to 3D
-        z = depth_image[u, v]
-        k = depth_info.k
-        px, py, fx, fy = k[2], k[5], k[0], k[4]
-        x = z * (v - px) / fx
-        y = z * (u - py) / fy
-        points_3d = np.dstack([x, y, z]).reshape(-1, 3) / \
-            self.depth_image_units_divisor  # convert to meters
+        keypoints_2d = np.fromiter(
+            (c for p in detection.keypoints.data
+             for c in (p.point.x, p.point.y)),
+            dtype=np.intp,
+            count=2 * num_keypoints
+        ).reshape(-1, 2)
+        u = keypoints_2d[:, 1].clip(0, depth_image.shape[0] - 1)
+        v = keypoints_2d[:, 0].clip(0, depth_image.shape[1] - 1)
+
+        # sample depth image, convert to meters and project to 3D
+        # writing straight into the (N, 3) output
+        points_3d = np.empty((num_keypoints, 3), dtype=np.float64)
+        points_3d[:, 0] = (v - self._px) * self._inv_fx
+        points_3d[:, 1] = (u - self._py) * self._inv_fy
+        points_3d[:, 2] = depth_image[u, v] * self._inv_div
+        points_3d[:, :2] *= points_3d[:, 2:]
+
+        # transform the keypoints with valid depth before creating
+        # the messages, so each one is only built once
+        indices = np.flatnonzero(~np.isnan(points_3d).any(axis=1))
+        points_3d = Detect3DNode.transform_3d_points(
+            points_3d[indices], translation, rotation)
 
         # generate message
-        msg_array = KeyPoint3DArray()
-        for p, d in zip(points_3d, detection.keypoints.data):
-            if not np.isnan(p).any():
-                msg = KeyPoint3D()
-                msg.point.x = p[0]
-                msg.point.y = p[1]
-                msg.point.z = p[2]
-                msg.id = d.id
-                msg.score = d.score
-                msg_array.data.append(msg)
-
+        data = [None] * len(indices)
+
+        for j, (i, p) in enumerate(zip(indices.tolist(),
+                                       points_3d.tolist())):
+            d = detection.keypoints.data[i]
+            msg = KeyPoint3D()
+            msg.point.x, msg.point.y, msg.point.z = p
+            msg.id = d.id
+            msg.score = d.score
+            data[j] = msg
+
+        msg_array.data = data
         return msg_array
 
     def get_transform(self, frame_id: str) -> Tuple[np.ndarray]:
@@ -390,10 +485,12 @@ class Detect3DNode(CascadeLifecycleNode):
                                     transform.transform.translation.y,
                                     transform.transform.translation.z])
 
-            rotation = np.array([transform.transform.rotation.w,
-                                 transform.transform.rotation.x,
-                                 transform.transform.rotation.y,
-                                 transform.transform.rotation.z])
+            rotation = Detect3DNode.quaternion_to_matrix(
+                transform.transform.rotation.w,
+                transform.transform.rotation.x,
+                transform.transform.rotation.y,
+                transform.transform.rotation.z
+            )
 
             return translation, rotation
 
@@ -402,69 +499,47 @@ class Detect3DNode(CascadeLifecycleNode):
             return None
 
     @staticmethod
-    def transform_3d_box(
-        bbox: BoundingBox3D,
+    def quaternion_to_matrix(
+        w: float,
+        x: float,
+        y: float,
+        z: float
+    ) -> np.ndarray:
+
+        return np.array([
+            [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+            [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+            [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]
+        ], dtype=np.float64)
+
+    @staticmethod
+    def transform_3d_boxes(
+        positions: np.ndarray,
+        sizes: np.ndarray,
         translation: np.ndarray,
         rotation: np.ndarray
-    ) -> BoundingBox3D:
-
-        # position
-        position = Detect3DNode.qv_mult(
-            rotation,
-            np.array([bbox.center.position.x,
-                      bbox.center.position.y,
-                      bbox.center.position.z])
-        ) + translation
-
-        bbox.center.position.x = position[0]
-        bbox.center.position.y = position[1]
-        bbox.center.position.z = position[2]
-
-        # size
-        size = Detect3DNode.qv_mult(
-            rotation,
-            np.array([bbox.size.x,
-                      bbox.size.y,
-                      bbox.size.z])
-        )
+    ) -> Tuple[np.ndarray, np.ndarray]:
 
-        bbox.size.x = abs(size[0])
-        bbox.size.y = abs(size[1])
-        bbox.size.z = abs(size[2])
+        # transform all the BBs at once
+        positions = Detect3DNode.transform_3d_points(
+            positions, translation, rotation)
 
-        return bbox
+        sizes = np.abs(sizes @ rotation.T)
+
+        return positions, sizes
 
     @staticmethod
-    def transform_3d_keypoints(
-        keypoints: KeyPoint3DArray,
+    def transform_3d_points(
+        points: np.ndarray,
         translation: np.ndarray,
-        rotation: np.ndarray,
-    ) -> KeyPoint3DArray:
-
-        for point in keypoints.data:
-            position = Detect3DNode.qv_mult(
-                rotation,
-                np.array([
-                    point.point.x,
-                    point.point.y,
-                    point.point.z
-                ])
-            ) + translation
-
-            point.point.x = position[0]
-            point.point.y = position[1]
-            point.point.z = position[2]
+        rotation: np.ndarray
+    ) -> np.ndarray:
 
-        return keypoints
+        # transform all the points at once
+        points = points @ rotation.T
+        points += translation
 
-    @staticmethod
-    def qv_mult(q: np.ndarray, v: np.ndarray) -> np.ndarray:
-        q = np.array(q, dtype=np.float64)
-        v = np.array(v, dtype=np.float64)
-        qvec = q[1:]
-        uv = np.cross(qvec, v)
-        uuv = np.cross(qvec, uv)
-        return v + 2 * (uv * q[0] + uuv)
+        return points
 
 
 def main():